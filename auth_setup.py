@@ -6,6 +6,7 @@ Sheets: Service Account (service-account.json)
 """
 
 import os
+import json
 import logging
 from google.oauth2.credentials import Credentials
 from google.oauth2 import service_account
@@ -13,6 +14,7 @@ from google.auth.transport.requests import Request
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+from gmail_utils import save_token
 
 # Configure logging
 logging.basicConfig(
@@ -28,30 +30,17 @@ SHEETS_SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 
 def clean_existing_auth():
     """Remove existing token to force re-authentication"""
-    if os.path.exists('token.json'):
-        try:
-            os.remove('token.json')
-            print("✅ Removed existing token.json")
-        except Exception as e:
-            print(f"⚠️  Could not remove token.json: {e}")
+    try:
+        os.remove('token.json')
+        print("✅ Removed existing token.json")
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"⚠️  Could not remove token.json: {e}")
 
 def authenticate_gmail():
     """Authenticate Gmail with OAuth 2.0"""
     
-    # Check for credentials file
-    if not os.path.exists('credentials.json'):
-        print("❌ credentials.json file not found!")
-        print("\nPlease follow these steps for Gmail OAuth:")
-        print("1. Go to https://console.cloud.google.com/")
-        print("2. Select your project (or create one)")
-        print("3. Go to APIs & Services → Library")
-        print("4. Enable 'Gmail API'")
-        print("5. Go to APIs & Services → Credentials")
-        print("6. Create OAuth 2.0 Client ID (Desktop application)")
-        print("7. Download as 'credentials.json' in this directory")
-        print("8. Make sure OAuth redirect URIs include: http://localhost:8080/")
-        return None
-    
     try:
         # Create OAuth flow
         flow = InstalledAppFlow.from_client_secrets_file('credentials.json', GMAIL_SCOPES)
@@ -64,15 +53,26 @@ def authenticate_gmail():
             success_message='✅ Gmail authentication successful! You can close this window.'
         )
         
-        # Save credentials
-        with open('token.json', 'w') as token:
-            token.write(creds.to_json())
+        # Save credentials (atomic, locked against a running backend/dashboard)
+        save_token(creds)
         
         print("✅ Successfully authenticated Gmail with OAuth!")
         print("✅ Gmail credentials saved to token.json")
         
         return creds
         
+    except FileNotFoundError:
+        print("❌ credentials.json file not found!")
+        print("\nPlease follow these steps for Gmail OAuth:")
+        print("1. Go to https://console.cloud.google.com/")
+        print("2. Select your project (or create one)")
+        print("3. Go to APIs & Services → Library")
+        print("4. Enable 'Gmail API'")
+        print("5. Go to APIs & Services → Credentials")
+        print("6. Create OAuth 2.0 Client ID (Desktop application)")
+        print("7. Download as 'credentials.json' in this directory")
+        print("8. Make sure OAuth redirect URIs include: http://localhost:8080/")
+        return None
     except Exception as e:
         print(f"❌ Gmail authentication failed: {e}")
         print("\nTroubleshooting:")
@@ -85,29 +85,17 @@ def authenticate_gmail():
 def check_service_account():
     """Check service account setup for Sheets"""
     
-    if not os.path.exists('service-account.json'):
-        print("❌ service-account.json file not found!")
-        print("\nPlease follow these steps for Sheets Service Account:")
-        print("1. Go to https://console.cloud.google.com/")
-        print("2. Go to IAM & Admin → Service Accounts")
-        print("3. Create Service Account: 'emailsummarizer-sheets'")
-        print("4. Create JSON key and download as 'service-account.json'")
-        print("5. Note the service account email (ends with .iam.gserviceaccount.com)")
-        print("6. Share your Google Sheet with this service account email")
-        return None
-    
     try:
+        # Read the key file once; it provides both credentials and the account email
+        with open('service-account.json', 'r') as f:
+            sa_data = json.load(f)
+        
         # Load and validate service account
-        credentials = service_account.Credentials.from_service_account_file(
-            'service-account.json', 
+        credentials = service_account.Credentials.from_service_account_info(
+            sa_data, 
             scopes=SHEETS_SCOPES
         )
-        
-        # Get service account email
-        with open('service-account.json', 'r') as f:
-            import json
-            sa_data = json.load(f)
-            sa_email = sa_data.get('client_email', 'Unknown')
+        sa_email = sa_data.get('client_email', 'Unknown')
         
         print("✅ Service account file found and valid!")
         print(f"✅ Service account email: {sa_email}")
@@ -115,6 +103,16 @@ def check_service_account():
         
         return credentials
         
+    except FileNotFoundError:
+        print("❌ service-account.json file not found!")
+        print("\nPlease follow these steps for Sheets Service Account:")
+        print("1. Go to https://console.cloud.google.com/")
+        print("2. Go to IAM & Admin → Service Accounts")
+        print("3. Create Service Account: 'emailsummarizer-sheets'")
+        print("4. Create JSON key and download as 'service-account.json'")
+        print("5. Note the service account email (ends with .iam.gserviceaccount.com)")
+        print("6. Share your Google Sheet with this service account email")
+        return None
     except Exception as e:
         print(f"❌ Service account validation failed: {e}")
         return None
@@ -122,7 +120,7 @@ def check_service_account():
 def test_gmail_access(creds):
     """Test Gmail API access"""
     try:
-        service = build('gmail', 'v1', credentials=creds, cache_discovery=False)
+        service = build('gmail', 'v1', credentials=creds, static_discovery=True)
         
         # Test getting user profile
         profile = service.users().getProfile(userId='me').execute()
@@ -152,7 +150,7 @@ def test_gmail_access(creds):
 def test_sheets_access(creds):
     """Test Google Sheets API access with service account"""
     try:
-        service = build('sheets', 'v4', credentials=creds, cache_discovery=False)
+        service = build('sheets', 'v4', credentials=creds, static_discovery=True)
         
         # Try to create a test spreadsheet
         spreadsheet = {
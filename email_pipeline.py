@@ -0,0 +1,128 @@
+# email_pipeline.py
+import asyncio
+import inspect
+import io
+import logging
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import List
+from gmail_utils import afetch_unread_page, mark_as_read
+from summarizer import asummarize_email, compress_body
+from sheets_utils import append_rows, TIMESTAMP_FORMAT
+
+logger = logging.getLogger(__name__)
+
+# Emails combined into one summary / sheet row
+UNREAD_BATCH_SIZE = 10
+
+@dataclass
+class ProcessResult:
+    """Outcome of one process_unread run"""
+    count: int = 0
+    batches: int = 0
+    senders: List[str] = field(default_factory=list)
+    summary: str = ""
+    marked: bool = False
+    # True when every listed unread email was fetched and no further page exists
+    complete: bool = True
+    timestamp: str = field(default_factory=lambda: datetime.now().isoformat())
+
+    @property
+    def history_done(self) -> bool:
+        """Whether the saved historyId may advance past this run: every unread email
+        was fetched, and any that were processed were also marked read"""
+        return self.complete and (not self.count or self.marked)
+
+    def to_dict(self) -> dict:
+        """JSON body served by the API"""
+        if not self.count:
+            return {"message": "No unread emails found", "count": 0}
+        return {
+            "status": "success",
+            "count": self.count,
+            "senders": self.senders,
+            "summary": self.summary,
+            "timestamp": self.timestamp
+        }
+
+async def summarize_batch(emails):
+    """Summarize a list of (msg_id, sender, subject, body) into one sheet row
+
+    Returns (row, senders, summary) where row is [senders, subjects, emails, summary];
+    the caller prepends the timestamp.
+    """
+    senders = []
+    subjects = []
+    bodies = []
+    
+    # Build the prompt and the sheet columns in one pass over the batch
+    prompt = io.StringIO()
+    for i, (_, sender, subject, body) in enumerate(emails):
+        if i:
+            prompt.write("\n\n")
+        prompt.write("Sender: ")
+        prompt.write(sender)
+        prompt.write("\nSubject: ")
+        prompt.write(subject)
+        prompt.write("\nBody: ")
+        prompt.write(compress_body(body))
+        senders.append(sender)
+        subjects.append(subject)
+        bodies.append(body)
+    combined_text = prompt.getvalue()
+
+    # Generate single summary for all emails
+    summary = await asummarize_email(combined_text)
+    
+    row = [
+        "\n".join(senders),
+        "\n".join(subjects),
+        "\n\n".join(bodies),
+        summary
+    ]
+    return row, senders, summary
+
+async def process_unread(gmail_service, sheet_service, max_batches: int = 1) -> ProcessResult:
+    """Fetch, summarize, store and mark read up to max_batches batches of unread emails
+
+    sheet_service may be an awaitable (e.g. a pending auth task); it is awaited only
+    once rows are ready. Rows are written with one append and emails are marked read
+    with one batchModify, only after the append succeeded. Gmail listing errors
+    propagate to the caller.
+    """
+    max_emails = UNREAD_BATCH_SIZE * max_batches
+    unread_emails, complete = await afetch_unread_page(gmail_service, max_emails)
+    if not unread_emails:
+        logger.info("No unread emails found")
+        return ProcessResult(complete=complete)
+
+    # One summary (and sheet row) per UNREAD_BATCH_SIZE emails, generated concurrently;
+    # any failure aborts before anything is written or marked read
+    batches = [
+        unread_emails[start:start + UNREAD_BATCH_SIZE]
+        for start in range(0, len(unread_emails), UNREAD_BATCH_SIZE)
+    ]
+    results = await asyncio.gather(*(summarize_batch(batch) for batch in batches))
+    
+    # Append all rows in a single call, stamped once for the whole run
+    timestamp = time.strftime(TIMESTAMP_FORMAT)
+    rows = [[timestamp] + row for row, _, _ in results]
+    if inspect.isawaitable(sheet_service):
+        sheet_service = await sheet_service
+    await asyncio.to_thread(append_rows, sheet_service, rows)
+    
+    # Mark emails as read only after their rows are persisted, never concurrently,
+    # so a failed summary or append leaves them unread for the next run
+    msg_ids = [msg_id for msg_id, _, _, _ in unread_emails]
+    marked = await asyncio.to_thread(mark_as_read, gmail_service, msg_ids)
+    
+    logger.info("Processed %d emails in %d batches", len(unread_emails), len(batches))
+    return ProcessResult(
+        count=len(unread_emails),
+        batches=len(batches),
+        senders=[sender for _, senders, _ in results for sender in senders],
+        summary="\n\n".join(summary for _, _, summary in results),
+        marked=marked,
+        complete=complete
+    )
@@ -1,10 +1,11 @@
 # frontend.py
 
+import asyncio
 import streamlit as st
-import pandas as pd
 import requests
+import time
+from requests.adapters import HTTPAdapter
 from datetime import datetime
-import plotly.express as px
 import os
 from dotenv import load_dotenv
 
@@ -22,19 +23,70 @@ st.set_page_config(
 # Backend API configuration
 BACKEND_URL = os.getenv("BACKEND_URL")
 
+# How long the dashboard polls a queued backend job before giving up
+JOB_POLL_INTERVAL = 1
+JOB_TIMEOUT = 60
+
+# With INPROC=1 the FastAPI handlers are called directly instead of over HTTP
+backend = None
+if os.getenv("INPROC") == "1":
+    try:
+        import main as backend
+        from fastapi import HTTPException
+        from jobs import load_latest_result
+    except Exception:
+        # Missing packages or settings (e.g. GROQ_API_KEY) fail the import; use HTTP
+        backend = None
+
+def call_backend_inproc(handler):
+    """Run a backend handler in this process, returning (status_code, payload) like an HTTP call"""
+    try:
+        return 200, asyncio.run(handler())
+    except HTTPException as e:
+        return e.status_code, {"detail": e.detail}
+
+@st.cache_resource
+def get_http_session():
+    """Shared keep-alive session so reruns reuse the backend connection"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=4)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+@st.cache_resource
+def prewarm_inproc_backend() -> bool:
+    """Authenticate the in-process backend's Gmail/Sheets services once per dashboard
+    process; the FastAPI lifespan that normally does this never runs here"""
+    try:
+        asyncio.run(backend.authenticate_services())
+        return True
+    except Exception:
+        # Handlers still authenticate on demand; /health reports them disconnected
+        return False
+
 def check_backend_connection():
     """Check if backend API is available"""
+    if backend is not None:
+        prewarm_inproc_backend()
+        status_code, payload = call_backend_inproc(backend.health_check)
+        return status_code == 200, payload
+    
     try:
-        response = requests.get(f"{BACKEND_URL}/health", timeout=5)
+        response = get_http_session().get(f"{BACKEND_URL}/health", timeout=5)
         return response.status_code == 200, response.json()
     except requests.exceptions.RequestException:
         return False, None
 
-@st.cache_data(ttl=1000)  # Cache for 5 minutes
+@st.cache_data(ttl=300)  # Cache for 5 minutes
 def load_email_data():
-    """Load email data from backend API"""
+    """Load the most recently processed batch from backend API (read-only)"""
+    if backend is not None:
+        # Read the record the running backend writes; this process never runs its scheduler
+        return load_latest_result() or {"message": "No emails processed yet", "count": 0}
+    
     try:
-        response = requests.get(f"{BACKEND_URL}/process-unread-emails", timeout=10)
+        response = get_http_session().get(f"{BACKEND_URL}/emails/latest", timeout=10)
         if response.status_code == 200:
             return response.json()
         return None
@@ -42,14 +94,37 @@ def load_email_data():
         st.error(f"Error connecting to backend: {e}")
         return None
 
+def run_backend_job(path):
+    """Start a queued backend job over HTTP and poll it, returning (status_code, payload)"""
+    session = get_http_session()
+    response = session.get(f"{BACKEND_URL}{path}", timeout=10)
+    if response.status_code != 202:
+        return response.status_code, response.json()
+    
+    status_url = f"{BACKEND_URL}{response.json()['status_url']}"
+    deadline = time.monotonic() + JOB_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(JOB_POLL_INTERVAL)
+        job = session.get(status_url, timeout=10).json()
+        if job.get('status') == 'done':
+            return 200, job['result']
+        if job.get('status') == 'failed':
+            return 500, {"detail": job.get('detail')}
+    return 504, {"detail": "Timed out waiting for the backend job"}
+
 def trigger_manual_summary():
     """Trigger manual processing of unread emails"""
     try:
         with st.spinner("Checking for unread emails..."):
-            response = requests.get(f"{BACKEND_URL}/process-unread-emails", timeout=30)
+            if backend is not None:
+                # Background jobs would not outlive asyncio.run, so wait for the result
+                status_code, result = call_backend_inproc(
+                    lambda: backend.process_unread_emails(wait=True)
+                )
+            else:
+                status_code, result = run_backend_job("/process-unread-emails")
             
-            if response.status_code == 200:
-                result = response.json()
+            if status_code == 200:
                 if result['count'] > 0:
                     st.success(f"✅ Processed {result['count']} emails")
                     st.balloons()
@@ -59,7 +134,7 @@ def trigger_manual_summary():
                     st.info("📭 No unread emails found")
                     return False
             else:
-                st.error(f"Error: {response.json().get('detail', 'Unknown error')}")
+                st.error(f"Error: {result.get('detail', 'Unknown error')}")
                 return False
     except requests.exceptions.RequestException as e:
         st.error(f"Connection error: {e}")
@@ -130,7 +205,9 @@ def main():
         return
     
     # Load data
+    # pandas/plotly are imported lazily so early-return reruns skip their import cost
     if demo_mode:
+        import pandas as pd
         data = create_sample_data()
         df = pd.DataFrame(data)
     else:
@@ -142,23 +219,30 @@ def main():
             return
         
         # Create DataFrame from API response
+        import pandas as pd
         df = pd.DataFrame([{
-            'Timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            'Timestamp': data.get('timestamp', datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
             'Sender': '\n'.join(data.get('senders', [])),
             'Subject': 'Combined Summary',
             'Email': 'Multiple emails processed',
             'Summary': data.get('summary', 'No summary available')
         }])
     
+    # Tokenize the Sender column once (vectorized) and reuse it for metrics and analytics
+    sender_series = df['Sender'].str.split('\n').explode().str.strip()
+    sender_series = sender_series[sender_series.fillna('') != '']
+    sender_counts = sender_series.value_counts()
+    senders_by_row = sender_series.groupby(level=0).agg(list)
+    
     # Statistics
     col1, col2, col3, col4 = st.columns(4)
     
     with col1:
-        email_count = len(df.iloc[0]['Sender'].split('\n')) if len(df) > 0 else 0
+        email_count = len(sender_series)
         st.metric("Emails Processed", email_count)
     
     with col2:
-        unique_senders = len(set(df.iloc[0]['Sender'].split('\n'))) if len(df) > 0 else 0
+        unique_senders = len(sender_counts)
         st.metric("Unique Senders", unique_senders)
     
     with col3:
@@ -181,14 +265,13 @@ def main():
             # Display each batch
             for idx, row in df.iterrows():
                 with st.expander(f"📧 Batch Summary - {row['Timestamp']}", expanded=True):
-                    senders = row['Sender'].split('\n') if row['Sender'] else []
+                    senders = senders_by_row.get(idx, [])
                     st.write(f"**Processed {len(senders)} emails**")
                     
                     # Display senders
                     st.write("**Senders:**")
                     for sender in senders:
-                        if sender.strip():
-                            st.write(f"• {sender}")
+                        st.write(f"• {sender}")
                     
                     # Display summary
                     st.write("**Combined Summary:**")
@@ -213,6 +296,8 @@ def main():
         st.header("Email Analytics")
         
         if len(df) > 0:
+            import plotly.express as px
+            
             # Sample visualization
             st.write("### Email Activity Over Time")
             
@@ -229,26 +314,18 @@ def main():
             st.plotly_chart(fig_timeline, use_container_width=True)
             
             # Sender distribution
-            if len(df) > 0 and df.iloc[0]['Sender']:
+            if not sender_counts.empty:
                 st.write("### Sender Distribution")
-                senders = df.iloc[0]['Sender'].split('\n')
-                sender_counts = {}
-                for sender in senders:
-                    if sender.strip():
-                        sender_counts[sender] = sender_counts.get(sender, 0) + 1
-                
-                if sender_counts:
-                    sender_df = pd.DataFrame(list(sender_counts.items()), 
-                                           columns=['sender', 'count'])
-                    fig_senders = px.pie(sender_df, values='count', names='sender',
-                                       title="Email Distribution by Sender")
-                    st.plotly_chart(fig_senders, use_container_width=True)
+                sender_df = sender_counts.rename_axis('sender').reset_index(name='count')
+                fig_senders = px.pie(sender_df, values='count', names='sender',
+                                   title="Email Distribution by Sender")
+                st.plotly_chart(fig_senders, use_container_width=True)
         else:
             st.info("Not enough data for analytics")
     
     # Footer
     st.markdown("---")
-    st.markdown(f"*Email Summarizer Dashboard - Backend: {BACKEND_URL}*")
+    st.markdown(f"*Email Summarizer Dashboard - Backend: {'in-process' if backend is not None else BACKEND_URL}*")
 
 if __name__ == "__main__":
     main()
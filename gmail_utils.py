@@ -1,13 +1,29 @@
 # gmail_utils.py
-import base64
+import asyncio
+import binascii
+import json
 import os
+import random
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager, suppress
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from typing import Tuple, Optional, List
+import html
 import logging
+from dotenv import load_dotenv
+from http_utils import authorized_http, build_request
+
+load_dotenv()
+
+try:
+    import fcntl
+except ImportError:  # Windows: token access is not locked across processes
+    fcntl = None
 
 # COMBINED SCOPES - This is the key fix!
 SCOPES = [
@@ -15,20 +31,122 @@ SCOPES = [
     'https://www.googleapis.com/auth/spreadsheets'
 ]
 
-def gmail_auth():
-    """Authenticate with Gmail API using combined scopes"""
+# Gmail accepts at most 100 sub-requests per batch call
+BATCH_SIZE = 100
+
+# Batch sub-request statuses (rate limit / transient backend errors) that are retried
+RETRYABLE_STATUSES = {429, 500, 503}
+
+# Throttled sub-requests are re-sent in smaller batches after an exponential
+# backoff (base seconds, doubled per attempt, plus up to as much jitter)
+RETRY_ATTEMPTS = 3
+RETRY_BACKOFF_SECONDS = 1.0
+RETRY_BATCH_SIZE = 10
+
+# Gmail accepts at most 1000 ids per batchModify call
+MODIFY_BATCH_SIZE = 1000
+
+# Partial-response masks: only request what header/body extraction reads.
+# FULL_BODY uses format='full' rather than 'raw': raw carries every attachment inline
+# and must be MIME-parsed whole, while extract_body decodes a single capped part.
+LIST_FIELDS = 'messages/id,nextPageToken'
+MESSAGE_FIELDS = 'id,payload/headers,payload/mimeType,payload/body/data,payload/parts(mimeType,filename,body/data,parts)'
+METADATA_FIELDS = 'id,snippet,payload/headers'
+
+# Set FULL_BODY=1 to download and decode full bodies instead of Gmail's snippet
+FULL_BODY = os.getenv("FULL_BODY") == "1"
+
+TOKEN_FILE = 'token.json'
+TOKEN_LOCK_FILE = TOKEN_FILE + '.lock'
+
+# Mailbox historyId of the last successfully processed poll
+HISTORY_FILE = 'history_state.json'
+
+# Parsed token.json, reused until the file's mtime changes
+_CRED_CACHE = {'mtime': None, 'creds': None}
+
+# Bodies are trimmed to this many characters after whitespace is collapsed
+MAX_BODY_CHARS = 2000
+
+# Bytes decoded per body: headroom for multi-byte UTF-8 and collapsed whitespace
+MAX_BODY_BYTES = MAX_BODY_CHARS * 4
+_B64_URLSAFE_TO_STD = str.maketrans('-_', '+/')
+
+# Process-wide Gmail service, rebuilt only when its credentials stop being valid
+_SERVICE = None
+_SERVICE_CREDS = None
+
+# (sender, subject, body) of fetched but not yet read messages, so a run that fails
+# before mark_as_read does not download them again; least recently used evicted first
+MAX_CACHED_MESSAGES = 1024
+_message_cache = OrderedDict()
+
+@contextmanager
+def _token_lock():
+    """Hold an exclusive lock on token.json.lock while reading/refreshing/writing the token
+
+    Serializes token access across the backend, dashboard and setup scripts so only one
+    process refreshes an expired token and the others pick up the rewritten file.
+    """
+    if fcntl is None:
+        yield
+        return
+    
+    with open(TOKEN_LOCK_FILE, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _load_token() -> Optional[Credentials]:
+    """Load token.json, reusing the parsed credentials while the file is unchanged"""
+    try:
+        mtime = os.stat(TOKEN_FILE).st_mtime_ns
+    except FileNotFoundError:
+        _CRED_CACHE['mtime'] = _CRED_CACHE['creds'] = None
+        return None
+    
+    if _CRED_CACHE['mtime'] != mtime:
+        _CRED_CACHE['creds'] = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
+        _CRED_CACHE['mtime'] = mtime
+    
+    return _CRED_CACHE['creds']
+
+def _save_token(creds):
+    """Atomically write credentials to token.json and refresh the parse cache"""
+    tmp_path = TOKEN_FILE + '.tmp'
+    with open(tmp_path, 'w') as token:
+        token.write(creds.to_json())
+    os.replace(tmp_path, TOKEN_FILE)
+    
+    _CRED_CACHE['mtime'] = os.stat(TOKEN_FILE).st_mtime_ns
+    _CRED_CACHE['creds'] = creds
+
+def save_token(creds):
+    """Write credentials to token.json under the token lock"""
+    with _token_lock():
+        _save_token(creds)
+
+def _remove_token():
+    """Delete token.json if it exists"""
+    try:
+        os.remove(TOKEN_FILE)
+    except FileNotFoundError:
+        pass
+
+def _obtain_credentials() -> Credentials:
+    """Load, refresh or interactively create Gmail credentials (caller holds the token lock)"""
     creds = None
     
     # Load existing token
-    if os.path.exists('token.json'):
-        try:
-            creds = Credentials.from_authorized_user_file('token.json', SCOPES)
-        except Exception as e:
-            logging.warning(f"Error loading existing token: {e}")
-            # Delete corrupted token file
-            if os.path.exists('token.json'):
-                os.remove('token.json')
-            creds = None
+    try:
+        creds = _load_token()
+    except Exception as e:
+        logging.warning("Error loading existing token: %s", e)
+        # Delete corrupted token file
+        _remove_token()
+        creds = None
     
     # If no valid credentials, get new ones
     if not creds or not creds.valid:
@@ -37,21 +155,12 @@ def gmail_auth():
                 creds.refresh(Request())
                 logging.info("Successfully refreshed token")
             except Exception as e:
-                logging.error(f"Error refreshing token: {e}")
+                logging.error("Error refreshing token: %s", e)
                 # Delete the invalid token and re-authenticate
-                if os.path.exists('token.json'):
-                    os.remove('token.json')
+                _remove_token()
                 creds = None
         
         if not creds:
-            if not os.path.exists('credentials.json'):
-                raise FileNotFoundError(
-                    "credentials.json file not found. Please download it from Google Cloud Console:\n"
-                    "1. Go to https://console.cloud.google.com/\n"
-                    "2. APIs & Services → Credentials\n"
-                    "3. Download OAuth 2.0 Client ID as 'credentials.json'"
-                )
-            
             try:
                 flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
                 
@@ -65,8 +174,15 @@ def gmail_auth():
                 
                 logging.info("Successfully obtained new credentials with combined scopes")
                 
+            except FileNotFoundError:
+                raise FileNotFoundError(
+                    "credentials.json file not found. Please download it from Google Cloud Console:\n"
+                    "1. Go to https://console.cloud.google.com/\n"
+                    "2. APIs & Services → Credentials\n"
+                    "3. Download OAuth 2.0 Client ID as 'credentials.json'"
+                )
             except Exception as e:
-                logging.error(f"OAuth flow failed: {e}")
+                logging.error("OAuth flow failed: %s", e)
                 raise Exception(
                     f"OAuth authentication failed: {e}\n\n"
                     "Please check:\n"
@@ -78,188 +194,361 @@ def gmail_auth():
         
         # Save credentials for next run
         try:
-            with open('token.json', 'w') as token:
-                token.write(creds.to_json())
+            _save_token(creds)
             logging.info("Credentials saved to token.json")
         except Exception as e:
-            logging.warning(f"Could not save token: {e}")
+            logging.warning("Could not save token: %s", e)
+    
+    return creds
+
+def gmail_auth():
+    """Authenticate with Gmail API using combined scopes"""
+    global _SERVICE, _SERVICE_CREDS
     
-    return build('gmail', 'v1', credentials=creds)
+    if _SERVICE is not None and _SERVICE_CREDS.valid:
+        return _SERVICE
+    
+    with _token_lock():
+        creds = _obtain_credentials()
+    
+    # Shared keep-alive transport and bundled discovery; see http_utils
+    _SERVICE = build(
+        'gmail', 'v1',
+        http=authorized_http(creds),
+        requestBuilder=build_request,
+        static_discovery=True
+    )
+    _SERVICE_CREDS = creds
+    return _SERVICE
+
+def gmail_service_ready() -> bool:
+    """Whether an authenticated Gmail service is cached"""
+    return _SERVICE is not None
 
 def get_credentials():
     """Get authenticated credentials for use in other modules"""
-    creds = None
-    
-    if os.path.exists('token.json'):
+    with _token_lock():
         try:
-            creds = Credentials.from_authorized_user_file('token.json', SCOPES)
+            creds = _load_token()
         except Exception as e:
-            logging.warning(f"Error loading token: {e}")
+            logging.warning("Error loading token: %s", e)
             return None
-    
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            try:
-                creds.refresh(Request())
-            except Exception as e:
-                logging.error(f"Error refreshing credentials: {e}")
+        
+        if not creds or not creds.valid:
+            if creds and creds.expired and creds.refresh_token:
+                try:
+                    creds.refresh(Request())
+                except Exception as e:
+                    logging.error("Error refreshing credentials: %s", e)
+                    return None
+                
+                try:
+                    _save_token(creds)
+                except Exception as e:
+                    logging.warning("Could not save token: %s", e)
+            else:
                 return None
-        else:
-            return None
-    
-    return creds
+        
+        return creds
+
+def fetch_latest_email(service) -> Tuple[Optional[str], Optional[str], Optional[str], Optional[str]]:
+    """Fetch the latest unread email as (msg_id, sender, subject, body)
 
-def fetch_latest_email(service) -> Tuple[Optional[str], Optional[str], Optional[str]]:
-    """Fetch the latest unread email"""
+    The message is left unread; callers mark it with mark_as_read once processed.
+    """
     try:
         # Get unread emails
         result = service.users().messages().list(
             userId='me', 
             maxResults=1, 
-            q="is:unread"
+            labelIds=['UNREAD'],
+            fields=LIST_FIELDS
         ).execute()
         
         if not result.get('messages'):
             logging.info("No unread emails found")
-            return None, None, None
+            return None, None, None, None
         
         msg_id = result['messages'][0]['id']
-        msg = service.users().messages().get(
-            userId='me', 
-            id=msg_id, 
-            format='full'
-        ).execute()
+        msg = _get_message_request(service, msg_id).execute()
         
         # Extract headers
-        headers = msg['payload'].get('headers', [])
-        sender = next((h['value'] for h in headers if h['name'] == 'From'), 'Unknown')
-        subject = next((h['value'] for h in headers if h['name'] == 'Subject'), 'No Subject')
+        headers = {h['name']: h['value'] for h in msg['payload'].get('headers', [])}
+        sender = headers.get('From', 'Unknown')
+        subject = headers.get('Subject', 'No Subject')
         
         # Extract body
-        body = extract_body(msg['payload'])
+        body = _message_body(msg)
         
-        # Mark as read (optional)
-        service.users().messages().modify(
-            userId='me',
-            id=msg_id,
-            body={'removeLabelIds': ['UNREAD']}
-        ).execute()
-        
-        logging.info(f"Successfully fetched email from {sender} with subject: {subject}")
-        return sender, subject, body
+        logging.info("Successfully fetched email from %s with subject: %s", sender, subject)
+        return msg_id, sender, subject, body
         
     except HttpError as error:
-        logging.error(f'Gmail API error: {error}')
-        return None, None, None
+        logging.error("Gmail API error: %s", error)
+        return None, None, None, None
     except Exception as e:
-        logging.error(f'Unexpected error fetching email: {e}')
-        return None, None, None
+        logging.error("Unexpected error fetching email: %s", e)
+        return None, None, None, None
+
+def _decode_body_data(data: str) -> str:
+    """Decode a base64url body, decoding only the prefix that can survive truncation"""
+    chunk = data[:(MAX_BODY_BYTES // 3 + 1) * 4].translate(_B64_URLSAFE_TO_STD)
+    raw = binascii.a2b_base64(chunk + '=' * (-len(chunk) % 4))
+    return raw.decode('utf-8', errors='replace')
 
 def extract_body(payload) -> str:
-    """Extract email body from payload"""
+    """Extract email body from payload, preferring text/plain over text/html"""
     body = ""
+    html_data = None
+    stack = deque([payload])
     
-    def get_body_recursive(part):
-        nonlocal body
-        if part.get('mimeType') == 'text/plain':
-            data = part.get('body', {}).get('data')
-            if data:
-                try:
-                    body = base64.urlsafe_b64decode(data).decode('utf-8')
-                    return True
-                except Exception as e:
-                    logging.warning(f"Error decoding plain text body: {e}")
-        elif part.get('mimeType') == 'text/html' and not body:
-            data = part.get('body', {}).get('data')
-            if data:
-                try:
-                    body = base64.urlsafe_b64decode(data).decode('utf-8')
-                except Exception as e:
-                    logging.warning(f"Error decoding HTML body: {e}")
+    while stack:
+        part = stack.pop()
+        
+        # Attachments never carry the readable body
+        if part.get('filename'):
+            continue
         
-        # Check parts recursively
         if 'parts' in part:
-            for subpart in part['parts']:
-                if get_body_recursive(subpart):
-                    return True
-        return False
+            # Reversed so subparts are visited in document order
+            stack.extend(reversed(part['parts']))
+            continue
+        
+        data = part.get('body', {}).get('data')
+        if not data:
+            continue
+        
+        mime_type = part.get('mimeType', '')
+        if mime_type == 'text/plain':
+            try:
+                body = _decode_body_data(data)
+                break
+            except Exception as e:
+                logging.warning("Error decoding plain text body: %s", e)
+        elif mime_type == 'text/html' and html_data is None:
+            html_data = data
     
-    get_body_recursive(payload)
+    # Only decode HTML when no plain text part was found
+    if not body and html_data:
+        try:
+            body = _decode_body_data(html_data)
+        except Exception as e:
+            logging.warning("Error decoding HTML body: %s", e)
     
     # Clean up and limit body
     if body:
         body = ' '.join(body.split())
-        body = body[:2000]
+        body = body[:MAX_BODY_CHARS]
     
     return body or "No readable content found"
 
 
-def fetch_unread_emails(service, max_results=10) -> List[Tuple[str, str, str, str]]:
-    """Fetch all unread emails and return list of (msg_id, sender, subject, body)"""
-    try:
-        # Get unread emails
-        result = service.users().messages().list(
+def _get_message_request(service, msg_id):
+    """Build a messages.get request: From/Subject metadata plus snippet, or the full payload with FULL_BODY=1"""
+    if FULL_BODY:
+        return service.users().messages().get(
             userId='me', 
-            maxResults=max_results, 
-            q="is:unread"
-        ).execute()
+            id=msg_id, 
+            format='full',
+            fields=MESSAGE_FIELDS
+        )
+    return service.users().messages().get(
+        userId='me', 
+        id=msg_id, 
+        format='metadata',
+        metadataHeaders=['From', 'Subject'],
+        fields=METADATA_FIELDS
+    )
+
+def _message_body(msg) -> str:
+    """Body text of a message fetched by _get_message_request"""
+    if FULL_BODY:
+        return extract_body(msg['payload'])
+    # Snippets come back HTML-escaped (e.g. &#39;)
+    return html.unescape(msg.get('snippet', '')) or "No readable content found"
+
+def _batch_get_messages(service, msg_ids) -> dict:
+    """Fetch messages in batched HTTP round trips, keyed by message id
+
+    Sub-requests rejected with a retryable status are re-sent up to RETRY_ATTEMPTS
+    times in batches of RETRY_BATCH_SIZE after a jittered exponential backoff. This
+    blocks the calling (worker) thread while it waits.
+    """
+    messages = {}
+    
+    def execute_batches(ids, retry_ids, batch_size):
+        def collect(request_id, response, exception):
+            if exception is None:
+                messages[request_id] = response
+            elif (retry_ids is not None and isinstance(exception, HttpError)
+                    and exception.resp.status in RETRYABLE_STATUSES):
+                retry_ids.append(request_id)
+            else:
+                logging.warning("Error fetching message %s: %s", request_id, exception)
         
-        if not result.get('messages'):
-            logging.info("No unread emails found")
-            return []
+        for start in range(0, len(ids), batch_size):
+            batch = service.new_batch_http_request(callback=collect)
+            for msg_id in ids[start:start + batch_size]:
+                batch.add(_get_message_request(service, msg_id), request_id=msg_id)
+            batch.execute()
+    
+    pending = list(msg_ids)
+    batch_size = BATCH_SIZE
+    for attempt in range(RETRY_ATTEMPTS + 1):
+        # The last attempt logs failures instead of collecting them for another retry
+        retry_ids = [] if attempt < RETRY_ATTEMPTS else None
+        execute_batches(pending, retry_ids, batch_size)
+        if not retry_ids:
+            break
         
-        emails = []
-        for msg in result['messages']:
-            msg_id = msg['id']
-            msg_data = service.users().messages().get(
-                userId='me', 
-                id=msg_id, 
-                format='full'
-            ).execute()
-            
-            # Extract headers
-            headers = msg_data['payload'].get('headers', [])
-            sender = next((h['value'] for h in headers if h['name'] == 'From'), 'Unknown')
-            subject = next((h['value'] for h in headers if h['name'] == 'Subject'), 'No Subject')
-            
-            # Extract body
-            body = extract_body(msg_data['payload'])
-            
-            emails.append((msg_id, sender, subject, body))
+        delay = RETRY_BACKOFF_SECONDS * 2 ** attempt
+        delay += random.uniform(0, delay)
+        logging.info("Retrying %d throttled message fetches in %.1fs", len(retry_ids), delay)
+        time.sleep(delay)
+        pending = retry_ids
+        batch_size = RETRY_BATCH_SIZE
+    
+    return messages
+
+def fetch_unread_page(service, max_results=10) -> Tuple[List[Tuple[str, str, str, str]], bool]:
+    """Fetch up to max_results unread emails as (emails, complete)
+
+    emails is a list of (msg_id, sender, subject, body). complete is True only when
+    every listed message was fetched and no further unread page exists. Listing and
+    batch transport errors are raised rather than reported as an empty inbox.
+    """
+    # Get unread emails
+    result = service.users().messages().list(
+        userId='me', 
+        maxResults=max_results, 
+        labelIds=['UNREAD'],
+        fields=LIST_FIELDS
+    ).execute()
+    
+    if not result.get('messages'):
+        logging.info("No unread emails found")
+        return [], True
+    
+    msg_ids = [msg['id'] for msg in result['messages']]
+    messages = _batch_get_messages(
+        service, [msg_id for msg_id in msg_ids if msg_id not in _message_cache]
+    )
+    
+    emails = []
+    for msg_id in msg_ids:
+        cached = _message_cache.get(msg_id)
+        if cached is not None:
+            # mark_as_read from another thread may drop the entry meanwhile
+            with suppress(KeyError):
+                _message_cache.move_to_end(msg_id)
+            emails.append((msg_id,) + cached)
+            continue
         
-        return emails
+        msg_data = messages.get(msg_id)
+        if msg_data is None:
+            continue
         
-    except HttpError as error:
-        logging.error(f'Gmail API error: {error}')
-        return []
-    except Exception as e:
-        logging.error(f'Unexpected error fetching emails: {e}')
-        return []
+        # Extract headers
+        headers = {h['name']: h['value'] for h in msg_data['payload'].get('headers', [])}
+        sender = headers.get('From', 'Unknown')
+        subject = headers.get('Subject', 'No Subject')
+        
+        # Extract body
+        body = _message_body(msg_data)
+        
+        _message_cache[msg_id] = (sender, subject, body)
+        emails.append((msg_id, sender, subject, body))
+    
+    while len(_message_cache) > MAX_CACHED_MESSAGES:
+        _message_cache.popitem(last=False)
+    
+    complete = len(emails) == len(msg_ids) and not result.get('nextPageToken')
+    return emails, complete
 
-def mark_as_read(service, msg_ids):
-    """Mark messages as read"""
+async def afetch_unread_page(service, max_results=10) -> Tuple[List[Tuple[str, str, str, str]], bool]:
+    """Async fetch_unread_page: runs the batched fetch in a worker thread"""
+    return await asyncio.to_thread(fetch_unread_page, service, max_results)
+
+def _read_history_id() -> Optional[str]:
+    """Return the historyId saved by the last successful poll, if any"""
+    try:
+        with open(HISTORY_FILE, 'r') as f:
+            return json.load(f).get('history_id')
+    except (FileNotFoundError, ValueError):
+        return None
+
+def save_history_id(history_id: str):
+    """Persist the historyId once a poll has been fully processed"""
+    tmp_path = HISTORY_FILE + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'history_id': history_id}, f)
+    os.replace(tmp_path, HISTORY_FILE)
+
+def check_new_unread(service) -> Tuple[bool, str]:
+    """Return (changed, history_id) for an incremental poll
+
+    changed is False only when no message arrived unread or was marked unread
+    since the saved historyId, so the full unread listing can be skipped.
+    history_id is the mailbox's current id, to be passed to save_history_id
+    after processing.
+    """
+    last_id = _read_history_id()
+    
+    if last_id is not None:
+        try:
+            result = service.users().history().list(
+                userId='me',
+                startHistoryId=last_id,
+                # labelAdded covers old messages marked unread again, not just new arrivals
+                historyTypes=['messageAdded', 'labelAdded'],
+                labelId='UNREAD',
+                maxResults=1,
+                fields='history/id,historyId'
+            ).execute()
+            return bool(result.get('history')), result['historyId']
+        except HttpError as error:
+            # 404 means the saved historyId has expired; fall back to a full scan
+            if error.resp.status != 404:
+                raise
+            logging.info("Saved historyId expired, doing a full unread scan")
+    
+    profile = service.users().getProfile(userId='me', fields='historyId').execute()
+    return True, profile['historyId']
+
+def mark_as_read(service, msg_ids) -> bool:
+    """Mark messages as read, returning whether every batch succeeded"""
     if not msg_ids:
-        return
+        return True
         
+    msg_ids = list(msg_ids)
+    
     try:
-        for msg_id in msg_ids:
-            service.users().messages().modify(
+        for start in range(0, len(msg_ids), MODIFY_BATCH_SIZE):
+            service.users().messages().batchModify(
                 userId='me',
-                id=msg_id,
-                body={'removeLabelIds': ['UNREAD']}
+                body={
+                    'ids': msg_ids[start:start + MODIFY_BATCH_SIZE],
+                    'removeLabelIds': ['UNREAD']
+                }
             ).execute()
-        logging.info(f"Marked {len(msg_ids)} emails as read")
+        logging.info("Marked %d emails as read", len(msg_ids))
+        for msg_id in msg_ids:
+            _message_cache.pop(msg_id, None)
+        return True
     except Exception as e:
-        logging.error(f"Error marking emails as read: {e}")
+        logging.error("Error marking emails as read: %s", e)
+        return False
 
 def count_unread_emails(service):
     """Count number of unread emails"""
     try:
-        result = service.users().messages().list(
+        # The UNREAD label keeps a running counter, so no message listing is needed
+        label = service.users().labels().get(
             userId='me',
-            q="is:unread"
+            id='UNREAD',
+            fields='messagesUnread'
         ).execute()
-        return result.get('resultSizeEstimate', 0)
+        return label.get('messagesUnread', 0)
     except Exception as e:
-        logging.error(f"Error counting unread emails: {e}")
+        logging.error("Error counting unread emails: %s", e)
         return 0
\ No newline at end of file
@@ -0,0 +1,35 @@
+# http_utils.py
+# Transport shared by the Gmail and Sheets clients. Services are built with
+#   build(..., http=authorized_http(creds), requestBuilder=build_request, static_discovery=True)
+# so every call reuses a persistent authorized connection (one per thread) and the
+# discovery document bundled with googleapiclient is loaded without an HTTPS fetch.
+import threading
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.http import HttpRequest
+import httplib2
+
+# Socket timeout (seconds) for Google API connections
+HTTP_TIMEOUT = 60
+
+# Distinct credentials kept per thread before the connection cache is reset
+MAX_CONNECTIONS_PER_THREAD = 8
+
+# Per-thread persistent connections; httplib2.Http must not be shared across threads
+_thread_local = threading.local()
+
+def authorized_http(credentials) -> AuthorizedHttp:
+    """Create a keep-alive authorized HTTP connection for the given credentials"""
+    return AuthorizedHttp(credentials, http=httplib2.Http(timeout=HTTP_TIMEOUT))
+
+def build_request(http, *args, **kwargs):
+    """requestBuilder for build(): run each request on the calling thread's own
+    persistent connection for the service's credentials"""
+    connections = getattr(_thread_local, 'connections', None)
+    if connections is None or len(connections) > MAX_CONNECTIONS_PER_THREAD:
+        connections = _thread_local.connections = {}
+
+    key = id(http.credentials)
+    cached = connections.get(key)
+    if cached is None or cached.credentials is not http.credentials:
+        cached = connections[key] = authorized_http(http.credentials)
+    return HttpRequest(cached, *args, **kwargs)
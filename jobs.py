@@ -0,0 +1,114 @@
+# jobs.py
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+import uuid
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# One JSON file per job, so any worker can answer /jobs/{job_id}
+JOBS_DIR = 'jobs'
+
+# Finished job records older than this are removed when new jobs are submitted
+JOB_TTL_SECONDS = 3600
+
+# Most recent processed batch, shared by every worker (and the in-process dashboard)
+LATEST_RESULT_FILE = 'latest_result.json'
+
+_JOB_ID_RE = re.compile(r'[0-9a-f]{32}')
+
+# Strong references to running jobs; the event loop only keeps weak ones
+_running = set()
+
+def _job_path(job_id: str) -> str:
+    return os.path.join(JOBS_DIR, f"{job_id}.json")
+
+def _write_json(path: str, data: dict):
+    """Atomically replace path with data; the temp name is per process"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+def _write_job(record: dict):
+    """Atomically store a job record"""
+    _write_json(_job_path(record['job_id']), record)
+
+def save_latest_result(result: dict):
+    """Record the most recent processed batch for /emails/latest"""
+    try:
+        _write_json(LATEST_RESULT_FILE, result)
+    except OSError as e:
+        # The batch is already stored and marked read; only the dashboard view is stale
+        logger.warning("Could not record latest result: %s", e)
+
+def load_latest_result() -> Optional[dict]:
+    """Return the most recent processed batch, or None if nothing was processed yet"""
+    try:
+        with open(LATEST_RESULT_FILE, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def _prepare_jobs_dir():
+    """Create JOBS_DIR and delete job records older than JOB_TTL_SECONDS"""
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    cutoff = time.time() - JOB_TTL_SECONDS
+    for entry in os.scandir(JOBS_DIR):
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+def _store_job(record: dict):
+    """Write a finished job's record, logging instead of raising on failure"""
+    try:
+        _write_job(record)
+    except OSError as e:
+        logger.warning("Could not record job %s: %s", record['job_id'], e)
+
+async def _run_job(job_id: str, job):
+    try:
+        result = await job()
+    except asyncio.CancelledError:
+        # Worker shutdown: record the job as failed so pollers stop waiting, written
+        # synchronously since the loop may not run another thread hop
+        _store_job({"job_id": job_id, "status": "failed", "detail": "Job cancelled"})
+        raise
+    except Exception as e:
+        # HTTPException carries its message in detail
+        detail = str(getattr(e, 'detail', e))
+        logger.error("Job %s failed: %s", job_id, detail)
+        record = {"job_id": job_id, "status": "failed", "detail": detail}
+    else:
+        record = {"job_id": job_id, "status": "done", "result": result}
+    await asyncio.to_thread(_store_job, record)
+
+async def submit_job(job) -> str:
+    """Run the coroutine function job in the background and return its job id
+
+    Directory housekeeping and the pending record are written in a worker thread.
+    """
+    job_id = uuid.uuid4().hex
+    await asyncio.to_thread(_prepare_jobs_dir)
+    await asyncio.to_thread(_write_job, {"job_id": job_id, "status": "pending"})
+
+    task = asyncio.create_task(_run_job(job_id, job))
+    _running.add(task)
+    task.add_done_callback(_running.discard)
+    return job_id
+
+def get_job(job_id: str) -> Optional[dict]:
+    """Return the stored record for job_id, or None if unknown or expired"""
+    if not _JOB_ID_RE.fullmatch(job_id):
+        return None
+    try:
+        with open(_job_path(job_id), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
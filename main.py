@@ -1,95 +1,154 @@
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from gmail_utils import gmail_auth, fetch_latest_email, fetch_unread_emails, mark_as_read
-from summarizer import summarize_email
-from sheets_utils import sheets_auth, append_to_sheet
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.interval import IntervalTrigger
-from contextlib import asynccontextmanager
+from fastapi.middleware.gzip import GZipMiddleware
+from gmail_utils import (
+    gmail_auth, fetch_latest_email, mark_as_read, check_new_unread,
+    save_history_id, gmail_service_ready
+)
+from summarizer import asummarize_email, compress_body
+from sheets_utils import (
+    sheets_auth, ensure_headers, append_to_sheet, sheets_service_ready
+)
+from email_pipeline import process_unread
+from jobs import submit_job, get_job, save_latest_result, load_latest_result
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, suppress
+import asyncio
 import logging
 import uvicorn
 from datetime import datetime
 import os
 from dotenv import load_dotenv
 
+try:
+    import fcntl
+except ImportError:  # Windows: every worker runs the scheduled job
+    fcntl = None
+
 # Load environment variables
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Configure logging once for the app; LOG_LEVEL=INFO shows per-run progress
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING").upper())
 logger = logging.getLogger(__name__)
 
-# Global scheduler
-scheduler = BackgroundScheduler()
+# Batches a scheduler tick may drain from an unread backlog
+MAX_BATCHES_PER_TICK = 5
+
+# Seconds between scheduled summarizer runs
+SCHEDULER_INTERVAL_SECONDS = 60
+
+# Threads for blocking Google API calls (asyncio.to_thread); each keeps its own
+# keep-alive connection, so this also bounds concurrent Google requests per worker
+GOOGLE_API_THREADS = int(os.getenv("GOOGLE_API_THREADS", "32"))
+
+# Held for the life of the one worker that runs the scheduled job
+SCHEDULER_LOCK_FILE = 'scheduler.lock'
+_scheduler_lock = None
+
 
-def auto_summarize_job():
-    """Background job to check and summarize emails"""
+def _sheets_ready():
+    """Authenticate Sheets and make sure the header row exists"""
+    sheet_service = sheets_auth()
+    ensure_headers(sheet_service)
+    return sheet_service
+
+async def authenticate_services():
+    """Return (gmail_service, sheet_service), authenticating both concurrently"""
+    return await asyncio.gather(
+        asyncio.to_thread(gmail_auth),
+        asyncio.to_thread(_sheets_ready)
+    )
+
+def _is_scheduler_leader() -> bool:
+    """Return True if this worker holds (or has just taken) the scheduler lock"""
+    global _scheduler_lock
+    if _scheduler_lock is not None or fcntl is None:
+        return True
     try:
-        gmail_service = gmail_auth()
-        sheet_service = sheets_auth()
+        lock_file = open(SCHEDULER_LOCK_FILE, 'w')
+    except OSError as e:
+        logger.error("Could not open scheduler lock %s: %s", SCHEDULER_LOCK_FILE, e)
+        return False
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError as e:
+        lock_file.close()
+        if not isinstance(e, BlockingIOError):
+            logger.error("Could not lock %s: %s", SCHEDULER_LOCK_FILE, e)
+        return False
+    _scheduler_lock = lock_file
+    logger.info("Worker %s is running the scheduled job", os.getpid())
+    return True
 
-        # Fetch all unread emails
-        unread_emails = fetch_unread_emails(gmail_service)
-        if not unread_emails:
-            logger.info("No unread emails found")
-            return
+def _discard_result(task):
+    """Retrieve a task's outcome so an unawaited failure is not logged as unhandled"""
+    if not task.cancelled():
+        task.exception()
 
-        msg_ids = []
-        senders = []
-        subjects = []
-        bodies = []
-        
-        # Process each email
-        for msg_id, sender, subject, body in unread_emails:
-            msg_ids.append(msg_id)
-            senders.append(sender)
-            subjects.append(subject)
-            bodies.append(body)
-
-        # Combine all emails into one text for summarization
-        combined_text = "\n\n".join(
-            f"Sender: {sender}\nSubject: {subject}\nBody: {body}"
-            for sender, subject, body in zip(senders, subjects, bodies)
-        )
+async def auto_summarize_job():
+    """Background job to check and summarize emails
 
-        # Generate single summary for all emails
-        summary = summarize_email(combined_text)
-        
-        # Prepare data for spreadsheet
-        combined_senders = "\n".join(senders)
-        combined_subjects = "\n".join(subjects)
-        combined_bodies = "\n\n".join(bodies)
+    Runs on the event loop; blocking Google API calls are offloaded to worker threads.
+    A backlog is drained in up to MAX_BATCHES_PER_TICK batches whose rows are written
+    with one append and whose emails are marked read with one batchModify.
+    """
+    try:
+        # With several workers only the lock holder polls; the lock is released when
+        # that process exits, and another worker takes over on its next tick
+        if not _is_scheduler_leader():
+            return
         
-        # Append to sheet
-        append_to_sheet(
-            sheet_service,
-            combined_senders,
-            combined_subjects,
-            combined_bodies,
-            summary
-        )
+        # Sheets is only needed once rows are ready, so its auth/header check runs
+        # alongside the Gmail fetch and Groq calls instead of ahead of them
+        sheets_task = asyncio.ensure_future(asyncio.to_thread(_sheets_ready))
+        sheets_task.add_done_callback(_discard_result)
+        gmail_service = await asyncio.to_thread(gmail_auth)
+
+        # Skip the full unread listing when nothing was added since the last poll
+        changed, history_id = await asyncio.to_thread(check_new_unread, gmail_service)
+        if not changed:
+            logger.info("No new emails since last poll")
+            return
+
+        result = await process_unread(gmail_service, sheets_task, MAX_BATCHES_PER_TICK)
         
-        # Mark emails as read after successful processing
-        mark_as_read(gmail_service, msg_ids)
+        # Only advance the history mark once every unread email was fetched, stored
+        # and marked read; fetch errors propagate and leave it in place
+        if result.history_done:
+            save_history_id(history_id)
         
-        logger.info(f"Processed {len(unread_emails)} emails")
+        if result.count:
+            await asyncio.to_thread(save_latest_result, result.to_dict())
 
     except Exception as e:
-        logger.error(f"Error in auto_summarize_job: {e}")
+        logger.error("Error in auto_summarize_job: %s", e)
+
+async def run_periodically(interval: float, job):
+    """Await job every interval seconds until cancelled"""
+    while True:
+        await asyncio.sleep(interval)
+        await job()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Startup
+    # Startup: size the pool that runs Google API calls, then build and cache
+    # both API services before the first request
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=GOOGLE_API_THREADS, thread_name_prefix="google-api")
+    )
+    try:
+        await authenticate_services()
+        logger.info("Gmail and Sheets services ready")
+    except Exception as e:
+        logger.warning("Could not prewarm API services: %s", e)
+    
+    scheduler_task = None
     if not os.getenv("DISABLE_SCHEDULER", "").lower() == "true":
-        scheduler.add_job(
-            func=auto_summarize_job,
-            trigger=IntervalTrigger(minutes=1),
-            id='email_summarizer_job',
-            name='Auto Email Summarizer',
-            replace_existing=True
+        scheduler_task = asyncio.create_task(
+            run_periodically(SCHEDULER_INTERVAL_SECONDS, auto_summarize_job)
         )
-        scheduler.start()
         logger.info("Email summarizer scheduler started")
     else:
         logger.info("Scheduler disabled via environment variable")
@@ -97,8 +156,10 @@ async def lifespan(app: FastAPI):
     yield
     
     # Shutdown
-    if scheduler.running:
-        scheduler.shutdown()
+    if scheduler_task is not None:
+        scheduler_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await scheduler_task
         logger.info("Email summarizer scheduler stopped")
 
 app = FastAPI(
@@ -108,15 +169,25 @@ app = FastAPI(
     lifespan=lifespan
 )
 
-# Add CORS middleware to allow frontend connections
+# Browser origins allowed to call the API (comma-separated); the Streamlit dashboard
+# calls it server-side and is unaffected
+CORS_ORIGINS = [
+    origin.strip()
+    for origin in os.getenv("CORS_ORIGINS", "http://localhost:8501").split(",")
+    if origin.strip()
+]
+
+# Add CORS middleware to allow frontend connections; every endpoint is a GET
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # Adjust this in production
+    allow_origins=CORS_ORIGINS,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET"],
 )
 
+# Compress larger JSON responses (summaries, sender lists) for the dashboard
+app.add_middleware(GZipMiddleware, minimum_size=500)
+
 @app.exception_handler(Exception)
 async def generic_exception_handler(request: Request, exc: Exception):
     return JSONResponse(
@@ -129,74 +200,80 @@ async def root():
     return {
         "message": "Email Summarizer API is running",
         "endpoints": {
-            "/summarize-latest": "GET - Manually fetch and summarize latest email",
-            "/process-unread-emails": "GET - Process all unread emails in batch",
+            "/summarize-latest": "GET - Queue summarizing the latest email (?wait=true to block)",
+            "/process-unread-emails": "GET - Queue processing unread emails in batch (?wait=true to block)",
+            "/emails/latest": "GET - Most recently processed batch (read-only)",
+            "/jobs/{job_id}": "GET - Status and result of a queued processing job",
             "/health": "GET - Service health check"
         }
     }
 
-@app.get("/process-unread-emails")
-async def process_unread_emails():
-    """Process all unread emails in batch"""
-    try:
-        gmail_service = gmail_auth()
-        sheet_service = sheets_auth()
+async def _accepted(job) -> JSONResponse:
+    """Queue job in the background and answer 202 with its id"""
+    job_id = await submit_job(job)
+    return JSONResponse(
+        status_code=202,
+        content={"job_id": job_id, "status": "pending", "status_url": f"/jobs/{job_id}"}
+    )
 
-        unread_emails = fetch_unread_emails(gmail_service)
-        if not unread_emails:
-            return {"message": "No unread emails found", "count": 0}
+@app.get("/process-unread-emails")
+async def process_unread_emails(wait: bool = False):
+    """Process all unread emails in batch, as a background job unless wait is set"""
+    if not wait:
+        return await _accepted(_process_unread_emails)
+    return await _process_unread_emails()
 
-        msg_ids = []
-        senders = []
-        subjects = []
-        bodies = []
-        
-        for msg_id, sender, subject, body in unread_emails:
-            msg_ids.append(msg_id)
-            senders.append(sender)
-            subjects.append(subject)
-            bodies.append(body)
-
-        combined_text = "\n\n".join(
-            f"Sender: {sender}\nSubject: {subject}\nBody: {body}"
-            for sender, subject, body in zip(senders, subjects, bodies)
-        )
+async def _process_unread_emails():
+    """Run one batch through the pipeline and record it as the latest result"""
+    try:
+        gmail_service, sheet_service = await authenticate_services()
 
-        summary = summarize_email(combined_text)
-        
-        append_to_sheet(
-            sheet_service,
-            "\n".join(senders),
-            "\n".join(subjects),
-            "\n\n".join(bodies),
-            summary
-        )
-        
-        mark_as_read(gmail_service, msg_ids)
-        
-        return {
-            "status": "success",
-            "count": len(unread_emails),
-            "senders": senders,
-            "summary": summary
-        }
+        result = await process_unread(gmail_service, sheet_service)
+        if result.count:
+            await asyncio.to_thread(save_latest_result, result.to_dict())
+        return result.to_dict()
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/emails/latest")
+async def get_latest_emails():
+    """Return the most recently processed batch without touching Gmail"""
+    latest_result = await asyncio.to_thread(load_latest_result)
+    if latest_result is None:
+        return {"message": "No emails processed yet", "count": 0}
+    return latest_result
+
+@app.get("/jobs/{job_id}")
+async def get_job_status(job_id: str):
+    """Return a queued job's status and, once finished, its result"""
+    job = await asyncio.to_thread(get_job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
 @app.get("/summarize-latest")
-async def summarize_and_store():
-    """Manually trigger email summarization"""
+async def summarize_and_store(wait: bool = False):
+    """Manually trigger email summarization, as a background job unless wait is set"""
+    if not wait:
+        return await _accepted(_summarize_latest)
+    return await _summarize_latest()
+
+async def _summarize_latest():
+    """Summarize, store and mark read the latest unread email"""
     try:
-        gmail_service = gmail_auth()
-        sheet_service = sheets_auth()
+        gmail_service, sheet_service = await authenticate_services()
 
-        sender, subject, email = fetch_latest_email(gmail_service)
-        if not sender:
+        msg_id, sender, subject, email = await asyncio.to_thread(fetch_latest_email, gmail_service)
+        if not msg_id:
             return {"message": "No unread email found."}
         
-        summary = summarize_email(f"Sender: {sender}\nSubject: {subject}\nBody: {email}")
-        append_to_sheet(sheet_service, sender, subject, email, summary)
+        summary = await asummarize_email(
+            f"Sender: {sender}\nSubject: {subject}\nBody: {compress_body(email)}"
+        )
+        await asyncio.to_thread(append_to_sheet, sheet_service, sender, subject, email, summary)
+        
+        await asyncio.to_thread(mark_as_read, gmail_service, [msg_id])
         
         return {
             "status": "success",
@@ -206,23 +283,14 @@ async def summarize_and_store():
             "timestamp": datetime.now().isoformat()
         }
     except Exception as e:
-        logger.error(f"Error in manual summarization: {e}")
+        logger.error("Error in manual summarization: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/health")
 async def health_check():
-    """Health check endpoint"""
-    try:
-        gmail_service = gmail_auth()
-        gmail_status = "connected" if gmail_service else "disconnected"
-    except:
-        gmail_status = "disconnected"
-    
-    try:
-        sheet_service = sheets_auth()
-        sheets_status = "connected" if sheet_service else "disconnected"
-    except:
-        sheets_status = "disconnected"
+    """Health check endpoint (reports cached services, makes no API calls)"""
+    gmail_status = "connected" if gmail_service_ready() else "disconnected"
+    sheets_status = "connected" if sheets_service_ready() else "disconnected"
     
     return {
         "status": "healthy",
@@ -234,11 +302,17 @@ async def health_check():
     }
 
 if __name__ == "__main__":
+    # DEV=1 runs a single auto-reloading process; otherwise WEB_CONCURRENCY workers
+    # (default 2*CPUs+1). uvicorn[standard] supplies uvloop and httptools, which
+    # uvicorn's default "auto" loop/http settings pick up when installed.
+    dev = os.getenv("DEV") == "1"
+    workers = 1 if dev else int(os.getenv("WEB_CONCURRENCY", (os.cpu_count() or 1) * 2 + 1))
     uvicorn.run(
         "main:app",
         host="0.0.0.0",
         port=8000,
-        reload=True,
-        log_level="info"
+        reload=dev,
+        workers=workers,
+        log_level=os.getenv("LOG_LEVEL", "WARNING").lower()
     )
 
@@ -2,10 +2,14 @@
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+from google.auth.exceptions import RefreshError
+import json
 import os
 from dotenv import load_dotenv
-from datetime import datetime
+import time
 import logging
+from typing import List
+from http_utils import authorized_http, build_request
 
 load_dotenv()
 
@@ -15,16 +19,25 @@ SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 SPREADSHEET_ID = os.getenv("SPREADSHEET_ID")
 SHEET_NAME = os.getenv("SHEET_NAME", "summary1")
 
+# Format of the Timestamp column
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Records which spreadsheet/tab already has its header row, so restarts skip the probe
+HEADERS_MARKER_FILE = 'sheet_headers.json'
+
+# Set once the header row is known to exist for SPREADSHEET_ID/SHEET_NAME
+_headers_verified = False
+
+# Process-wide Sheets service; service-account tokens refresh themselves, so it is
+# only rebuilt after reset_sheets_service() (append_rows does so on a RefreshError)
+_service = None
+
 def sheets_auth():
     """Authenticate with Google Sheets API using service account"""
-    if not os.path.exists('service-account.json'):
-        raise FileNotFoundError(
-            "service-account.json file not found. Please download it from Google Cloud Console:\n"
-            "1. Go to https://console.cloud.google.com/\n"
-            "2. IAM & Admin → Service Accounts\n"
-            "3. Create or select your service account\n"
-            "4. Create key (JSON) and save as 'service-account.json'"
-        )
+    global _service
+    
+    if _service is not None:
+        return _service
     
     try:
         # Load service account credentials
@@ -33,11 +46,25 @@ def sheets_auth():
             scopes=SCOPES
         )
         
-        # Build service without cache_discovery parameter
-        return build('sheets', 'v4', credentials=credentials).spreadsheets()
+        # Shared keep-alive transport and bundled discovery; see http_utils
+        _service = build(
+            'sheets', 'v4',
+            http=authorized_http(credentials),
+            requestBuilder=build_request,
+            static_discovery=True
+        ).spreadsheets()
+        return _service
         
+    except FileNotFoundError:
+        raise FileNotFoundError(
+            "service-account.json file not found. Please download it from Google Cloud Console:\n"
+            "1. Go to https://console.cloud.google.com/\n"
+            "2. IAM & Admin → Service Accounts\n"
+            "3. Create or select your service account\n"
+            "4. Create key (JSON) and save as 'service-account.json'"
+        )
     except Exception as e:
-        logging.error(f"Service account authentication failed: {e}")
+        logging.error("Service account authentication failed: %s", e)
         raise Exception(
             f"Service account authentication failed: {e}\n\n"
             "Please check:\n"
@@ -46,60 +73,111 @@ def sheets_auth():
             "3. Spreadsheet is shared with service account email"
         )
 
+def reset_sheets_service():
+    """Drop the cached service so the next sheets_auth() reloads service-account.json"""
+    global _service
+    _service = None
+
+def sheets_service_ready() -> bool:
+    """Whether an authenticated Sheets service is cached"""
+    return _service is not None
+
 def get_sheets_service():
     """Get authenticated Sheets service"""
     return sheets_auth()
 
-def append_to_sheet(service, senders: str, subjects: str, emails: str, summary: str):
-    """Append combined email data to spreadsheet"""
+def _headers_marker() -> dict:
+    """Identify the sheet whose header row was verified"""
+    return {"spreadsheet_id": SPREADSHEET_ID, "sheet_name": SHEET_NAME}
+
+def _headers_marked() -> bool:
+    """Whether a previous run already verified the header row for this sheet"""
     try:
-        if not SPREADSHEET_ID:
-            raise ValueError("SPREADSHEET_ID not set in environment variables")
-            
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with open(HEADERS_MARKER_FILE, 'r') as f:
+            return json.load(f) == _headers_marker()
+    except (FileNotFoundError, ValueError):
+        return False
+
+def ensure_headers(service):
+    """Add the header row if the sheet is empty
+
+    The check runs once: the result is cached in-process and recorded in
+    HEADERS_MARKER_FILE, so later calls (and restarts) make no API request.
+    Delete that file if the sheet is cleared.
+    """
+    global _headers_verified
+    
+    if not SPREADSHEET_ID:
+        raise ValueError("SPREADSHEET_ID not set in environment variables")
+    
+    if _headers_verified:
+        return
+    if _headers_marked():
+        _headers_verified = True
+        return
+    
+    try:
+        result = service.values().get(
+            spreadsheetId=SPREADSHEET_ID,
+            range=f"{SHEET_NAME}!A1:E1"
+        ).execute()
         
-        # First check if headers exist
-        try:
-            result = service.values().get(
+        if not result.get('values'):
+            # Add headers if sheet is empty; written in place (not appended) so workers
+            # that probe the empty sheet concurrently all write the same single row
+            service.values().update(
                 spreadsheetId=SPREADSHEET_ID,
-                range=f"{SHEET_NAME}!A1:E1"
+                range=f"{SHEET_NAME}!A1:E1",
+                valueInputOption="RAW",
+                body={"values": [["Timestamp", "Sender", "Subject", "Email", "Summary"]]}
             ).execute()
-            
-            if not result.get('values'):
-                # Add headers if sheet is empty
-                service.values().append(
-                    spreadsheetId=SPREADSHEET_ID,
-                    range=f"{SHEET_NAME}!A1",
-                    valueInputOption="RAW",
-                    body={"values": [["Timestamp", "Sender", "Subject", "Email", "Summary"]]}
-                ).execute()
-        except HttpError as e:
-            if e.resp.status == 403:
-                raise PermissionError("Insufficient permissions to access the spreadsheet")
-            raise
-
-        # Append the data
-        service.values().append(
-            spreadsheetId=SPREADSHEET_ID,
-            range=f"{SHEET_NAME}!A:E",
-            valueInputOption="RAW",
-            body={
-                "values": [[
-                    timestamp,
-                    senders,
-                    subjects,
-                    emails,
-                    summary
-                ]]
-            }
-        ).execute()
+    except HttpError as e:
+        if e.resp.status == 403:
+            raise PermissionError("Insufficient permissions to access the spreadsheet")
+        raise
+    
+    _headers_verified = True
+    try:
+        with open(HEADERS_MARKER_FILE, 'w') as f:
+            json.dump(_headers_marker(), f)
+    except OSError as e:
+        logging.warning("Could not record verified headers: %s", e)
+
+def _append_values(service, rows: List[List[str]]):
+    service.values().append(
+        spreadsheetId=SPREADSHEET_ID,
+        range=f"{SHEET_NAME}!A:E",
+        valueInputOption="RAW",
+        insertDataOption="INSERT_ROWS",
+        body={"values": rows}
+    ).execute()
+
+def append_rows(service, rows: List[List[str]]):
+    """Append [timestamp, senders, subjects, emails, summary] rows in a single call
+    (call ensure_headers first)"""
+    try:
+        if not SPREADSHEET_ID:
+            raise ValueError("SPREADSHEET_ID not set in environment variables")
+
+        try:
+            _append_values(service, rows)
+        except RefreshError:
+            # Cached credentials can no longer mint tokens; rebuild from the key file once
+            logging.warning("Sheets credentials refresh failed, re-authenticating")
+            reset_sheets_service()
+            _append_values(sheets_auth(), rows)
         
-        # logging.info(f"Added batch of {len(senders.split('\n'))} emails to spreadsheet")
+        logging.info("Appended %d rows to spreadsheet", len(rows))
         
     except Exception as e:
-        logging.error(f'Error appending to sheet: {e}')
+        logging.error("Error appending to sheet: %s", e)
         raise
 
+def append_to_sheet(service, senders: str, subjects: str, emails: str, summary: str):
+    """Append combined email data to spreadsheet (call ensure_headers first)"""
+    timestamp = time.strftime(TIMESTAMP_FORMAT)
+    append_rows(service, [[timestamp, senders, subjects, emails, summary]])
+
 
 def test_sheets_connection():
     """Test Google Sheets connection"""
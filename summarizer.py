@@ -1,42 +1,79 @@
-from groq import Groq
+from groq import AsyncGroq
+import asyncio
 import os
 from dotenv import load_dotenv
 import logging
+import summarizer_cache
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Logging is configured by the application (main.py), not on import
 logger = logging.getLogger(__name__)
 
 load_dotenv()
-client = Groq(api_key=os.getenv("GROQ_API_KEY"))
+
+# AsyncGroq's connection pool belongs to one event loop (the dashboard's in-process
+# mode runs each call in a fresh loop), so the client is recreated per loop
+_async_client = None
+_async_client_loop = None
+
+def _get_async_client() -> AsyncGroq:
+    """Return the AsyncGroq client bound to the running event loop"""
+    global _async_client, _async_client_loop
+    loop = asyncio.get_running_loop()
+    if _async_client is None or _async_client_loop is not loop:
+        _async_client = AsyncGroq(api_key=os.getenv("GROQ_API_KEY"))
+        _async_client_loop = loop
+    return _async_client
         
         
-def summarize_email(text: str) -> str:
+# Prompt and sampling settings for every summary request
+_SYSTEM_MSG = {
+    "role": "system", 
+    "content": "You are processing multiple emails at once. Each email starts with 'Sender: [sender]', 'Subject: [subject]', and 'Body: [content]'. "
+    "Provide a comprehensive summary that covers all emails, highlighting: "
+    "1. Key senders and their main points "
+    "2. Common themes across emails "
+    "3. Important action items "
+    "4. Any urgent matters "
+    "Format your response with clear sections and bullet points."
+}
+_KWARGS = dict(
+    model="llama3-8b-8192",
+    temperature=0.3,  # Lower for more consistent summaries
+    max_tokens=500,   # Increased for longer summaries
+    top_p=0.9
+)
+
+# Bodies longer than COMPRESS_MAX_CHARS keep only their head and tail in the prompt
+COMPRESS_MAX_CHARS = 1500
+COMPRESS_HEAD_CHARS = 1000
+COMPRESS_TAIL_CHARS = 300
+
+def compress_body(body: str, max_chars: int = COMPRESS_MAX_CHARS) -> str:
+    """Head+tail truncate an email body to cut prompt tokens sent to Groq"""
+    if len(body) < max_chars:
+        return body
+    return body[:COMPRESS_HEAD_CHARS] + "\n…[truncated]…\n" + body[-COMPRESS_TAIL_CHARS:]
+
+async def asummarize_email(text: str) -> str:
+    """Summarize email text with Groq, serving repeated prompts from summarizer_cache"""
+    cached = summarizer_cache.get_summary(text)
+    if cached is not None:
+        logger.info("Summary served from cache")
+        return cached
     try:
-        response = client.chat.completions.create(
-            model="llama3-8b-8192",
-            messages=[
-                {
-                    "role": "system", 
-                    "content": "You are processing multiple emails at once. Each email starts with 'Sender: [sender]', 'Subject: [subject]', and 'Body: [content]'. "
-                    "Provide a comprehensive summary that covers all emails, highlighting: "
-                    "1. Key senders and their main points "
-                    "2. Common themes across emails "
-                    "3. Important action items "
-                    "4. Any urgent matters "
-                    "Format your response with clear sections and bullet points."
-                },
-                {
-                    "role": "user", 
-                    "content": text
-                }
-            ],
-            temperature=0.3,  # Lower for more consistent summaries
-            max_tokens=500,   # Increased for longer summaries
-            top_p=0.9
+        response = await _get_async_client().chat.completions.create(
+            messages=[_SYSTEM_MSG, {"role": "user", "content": text}], **_KWARGS
         )
         
-        return response.choices[0].message.content.strip()
+        summary = response.choices[0].message.content.strip()
+        summarizer_cache.put_summary(text, summary)
+        return summary
     except Exception as e:
-        return f"Error generating summary: {str(e)}"
-    
+        # Raise instead of returning an error string so callers neither store it
+        # as a summary nor mark the emails as read
+        logger.error("Error generating summary: %s", e)
+        raise RuntimeError(f"Error generating summary: {str(e)}") from e
+
+def summarize_email(text: str) -> str:
+    """Blocking asummarize_email for scripts; not for use inside a running event loop"""
+    return asyncio.run(asummarize_email(text))
@@ -0,0 +1,29 @@
+# summarizer_cache.py
+import hashlib
+from collections import OrderedDict
+from typing import Optional
+
+# Summaries kept in memory; least recently used entries are evicted first
+MAX_CACHE_ENTRIES = 256
+
+_summaries = OrderedDict()
+
+def _key(text: str) -> bytes:
+    """Digest identifying a prompt text"""
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+def get_summary(text: str) -> Optional[str]:
+    """Return the cached summary for an identical prompt, if any"""
+    key = _key(text)
+    summary = _summaries.get(key)
+    if summary is not None:
+        _summaries.move_to_end(key)
+    return summary
+
+def put_summary(text: str, summary: str) -> None:
+    """Remember the summary generated for a prompt"""
+    key = _key(text)
+    _summaries[key] = summary
+    _summaries.move_to_end(key)
+    while len(_summaries) > MAX_CACHE_ENTRIES:
+        _summaries.popitem(last=False)
@@ -0,0 +1,71 @@
+# tests/test_history.py
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import gmail_utils
+from email_pipeline import ProcessResult
+
+
+class HistoryDoneTest(unittest.TestCase):
+    """When the scheduler may advance the saved historyId"""
+
+    def test_empty_complete_listing_advances(self):
+        self.assertTrue(ProcessResult(complete=True).history_done)
+
+    def test_empty_incomplete_listing_does_not_advance(self):
+        self.assertFalse(ProcessResult(complete=False).history_done)
+
+    def test_processed_and_marked_advances(self):
+        self.assertTrue(ProcessResult(count=3, marked=True, complete=True).history_done)
+
+    def test_not_marked_read_does_not_advance(self):
+        self.assertFalse(ProcessResult(count=3, marked=False, complete=True).history_done)
+
+    def test_backlog_left_does_not_advance(self):
+        self.assertFalse(ProcessResult(count=50, marked=True, complete=False).history_done)
+
+
+class CheckNewUnreadTest(unittest.TestCase):
+    """check_new_unread's skip decision"""
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        patcher = mock.patch.object(
+            gmail_utils, 'HISTORY_FILE', os.path.join(tmp_dir.name, 'history_state.json')
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.service = mock.MagicMock()
+
+    def test_without_saved_id_does_full_scan(self):
+        self.service.users().getProfile().execute.return_value = {'historyId': '7'}
+
+        self.assertEqual(gmail_utils.check_new_unread(self.service), (True, '7'))
+
+    def test_queries_new_and_re_unread_messages(self):
+        gmail_utils.save_history_id('5')
+        history_list = self.service.users().history().list
+        history_list.return_value.execute.return_value = {'historyId': '9'}
+
+        self.assertEqual(gmail_utils.check_new_unread(self.service), (False, '9'))
+        kwargs = history_list.call_args.kwargs
+        self.assertEqual(kwargs['startHistoryId'], '5')
+        self.assertEqual(kwargs['labelId'], 'UNREAD')
+        self.assertEqual(set(kwargs['historyTypes']), {'messageAdded', 'labelAdded'})
+
+    def test_unread_change_is_reported(self):
+        gmail_utils.save_history_id('5')
+        history_list = self.service.users().history().list
+        history_list.return_value.execute.return_value = {
+            'history': [{'id': '8'}],
+            'historyId': '9'
+        }
+
+        self.assertEqual(gmail_utils.check_new_unread(self.service), (True, '9'))
+
+
+if __name__ == '__main__':
+    unittest.main()